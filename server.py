@@ -1,156 +1,426 @@
 #!/usr/bin/env python3
 import asyncio
+import functools
+import hashlib
 import logging
-import uuid
+import os
+import secrets
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from inspect import signature
+
+import msgpack
+import orjson
 from aiohttp import web
 from aiohttp.client import ClientResponse
+from aiohttp_cors import setup as cors_setup, ResourceOptions
 
 import vyper
 from vyper.compiler import compile_code
 from vyper.exceptions import VyperException
 
-from concurrent.futures import ThreadPoolExecutor
-
 routes = web.RouteTableDef()
-headers = {
-    "Access-Control-Allow-Origin": "*",
-    "Access-Control-Allow-Headers": "X-Requested-With, Content-type"
-}
-executor_pool = ThreadPoolExecutor(max_workers=4)
-
-# Global dictionary for storing compilation results.
-compilation_results = {}
-
-@routes.options('/{tail:.*}')
-async def options_handler(request):
-    return web.Response(headers={
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type',
-        'Access-Control-Max-Age': '86400',
-    })
+_compile_code_signature = signature(compile_code)
+
+# compile_code is CPU-bound and holds the GIL, so compile in separate processes.
+# One worker per core, at least 2 and capped at 16 to limit contention on very
+# large hosts; COMPILE_WORKERS overrides it.
+# Note that _cached_compile's cache is per worker process.
+def _new_executor_pool():
+    return ProcessPoolExecutor(
+        max_workers=int(os.getenv("COMPILE_WORKERS", max(2, min(os.cpu_count() or 2, 16))))
+    )
+
+executor_pool = _new_executor_pool()
+
+def _replace_broken_pool(pool):
+    # A worker that dies (e.g. OOM-killed) breaks the whole pool and every later
+    # submit fails, so swap in a fresh one. Only the first request to notice
+    # replaces it; the others see it has already been swapped.
+    global executor_pool
+    if executor_pool is pool:
+        logging.error("Compile worker died; restarting the process pool")
+        executor_pool = _new_executor_pool()
+        pool.shutdown(wait=False)
+
+# Compilation results live in SQLite rather than process memory, so they survive
+# restarts and don't grow the heap with traffic. Rows older than RESULTS_TTL
+# seconds are hidden from lookups and periodically deleted, as are the oldest
+# rows beyond the newest RESULTS_MAX. The connection is
+# only used from the single db_pool thread, which keeps blob reads, writes and
+# WAL checkpoints off the event loop; never touch it from the compile workers.
+RESULTS_DB = os.getenv("RESULTS_DB", "artifacts.db")
+RESULTS_TTL = int(os.getenv("RESULTS_TTL", 3600))
+RESULTS_MAX = int(os.getenv("RESULTS_MAX", 100000))
+results_db = web.AppKey("results_db", sqlite3.Connection)
+db_pool = ThreadPoolExecutor(max_workers=1)
+
+# Bound the number of /compile requests being read or compiled at once; excess
+# requests wait here instead of piling up bodies and executor jobs.
+_compile_inflight = int(os.getenv("COMPILE_INFLIGHT", 8))
+_compile_sem = asyncio.Semaphore(_compile_inflight)
+# Once this many requests are also waiting for the semaphore, reject new ones
+# with 429 so clients back off rather than deepening the queue.
+_compile_max_waiting = int(os.getenv("COMPILE_MAX_WAITING", 16))
+_compile_pending = 0
+_last_busy_log = 0.0
+# Compiles currently running, keyed by request body hash, mapped to their
+# future and the pool running them. Identical requests that arrive while one is
+# in flight await the same future instead of compiling again. Only touched
+# from the event loop, so no lock is needed.
+_inflight = {}
+# Largest accepted request body, in bytes.
+client_max_size = int(os.getenv("CLIENT_MAX_SIZE", 1024 ** 2))
+
+def _json(obj, status=200, headers=None):
+    # orjson encodes large artifacts (long bytecode strings) much faster than the
+    # stdlib json used by web.json_response.
+    return web.Response(body=orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+                        status=status, headers=headers,
+                        content_type="application/json")
+
+async def _send_bytes(request, body, content_type, status=200, headers=None):
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_type = content_type
+    response.content_length = len(body)
+    await response.prepare(request)
+    await response.write(body)
+    await response.write_eof()
+    return response
+
+def _wants_msgpack(request):
+    # True if an Accept entry names msgpack with a non-zero quality.
+    for entry in request.headers.get("Accept", "").split(","):
+        media_type, _, params = entry.partition(";")
+        if "msgpack" not in media_type:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            return True
+    return False
 
 @routes.get('/')
 async def handle(request):
     return web.Response(text='Vyper Compiler. Version: {} \n'.format(vyper.__version__))
 
+# Top-level fields of the ethpm/3 artifact; "sources" and "contractTypes" are
+# filled in per compile. Copied shallowly, so every value here must stay immutable.
+_ARTIFACT_TEMPLATE = {
+    "manifest": "ethpm/3",
+    "name": None,
+    "version": None,
+    "meta": None,
+    "sources": None,
+    "contractTypes": None,
+    "compilers": None,
+    "deployments": None,
+    "buildDependencies": None
+}
+
+def _str_keys(source_map):
+    # Vyper keys several source_map tables by int pc. Use str keys so the JSON and
+    # msgpack encodings match and msgpack decodes with default settings.
+    if not isinstance(source_map, dict):
+        return source_map
+    return {
+        name: {str(pc): v for pc, v in table.items()} if isinstance(table, dict) else table
+        for name, table in source_map.items()
+    }
+
+def _build_artifact(code, source_key, out_dict):
+    # Contract name is the file name up to its first dot, e.g. "ERC20" for "tokens/ERC20.vy".
+    contract_name = source_key.rpartition('/')[2].partition('.')[0]
+    artifact = _ARTIFACT_TEMPLATE.copy()
+    artifact["sources"] = {
+        source_key: {
+            "content": code,
+            "urls": [],
+            "checksum": None,
+            "type": None,
+            "license": None,
+            "references": None,
+            "imports": None
+        }
+    }
+    artifact["contractTypes"] = {
+        contract_name: {
+            "contractName": contract_name,
+            "sourceId": source_key,
+            "deploymentBytecode": {
+                "bytecode": out_dict.get("bytecode", ""),
+                "linkReferences": None,
+                "linkDependencies": None
+            },
+            "runtimeBytecode": {
+                "bytecode": out_dict.get("bytecode_runtime", ""),
+                "linkReferences": None,
+                "linkDependencies": None
+            },
+            "abi": out_dict.get("abi", []),
+            "sourcemap": _str_keys(out_dict.get("source_map", "")),
+            "methodIdentifiers": out_dict.get("method_identifiers", {})
+        }
+    }
+    return artifact
+
+_OUTPUT_FORMATS = ('abi', 'bytecode', 'bytecode_runtime', 'source_map', 'method_identifiers')
+
+# Memoize compiler output so resubmitting identical code (e.g. editor autosave)
+# skips the compiler entirely. Failed compiles raise and so are not cached.
+@functools.lru_cache(maxsize=int(os.getenv("ARTIFACT_CACHE_MAX", 128)))
+def _cached_compile(code, path, formats):
+    return compile_code(code, path, output_formats=list(formats))
+
 def _compile(data):
     # Add debug information about Vyper
-    logging.debug(f"Vyper version: {vyper.__version__}")
-    from inspect import signature
-    logging.debug(f"compile_code signature: {signature(compile_code)}")
-    
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Vyper version: %s", vyper.__version__)
+        logging.debug("compile_code signature: %s", _compile_code_signature)
+
     # Ensure the "sources" key exists and has at least one file.
     if "sources" not in data:
         return {"status": "failed", "message": "Missing sources key"}, 400
     if not data["sources"]:
         return {"status": "failed", "message": "No sources provided"}, 400
+    if not isinstance(data["sources"], dict):
+        return {"status": "failed", "message": "sources must be an object"}, 400
 
     # Grab the first file from the sources.
     first_source_key, first_source_value = next(iter(data['sources'].items()))
-    logging.debug(f"Source key (contract_path): {first_source_key}")
-    logging.debug(f"Source value: {first_source_value}")
-    
+    logging.debug("Source key (contract_path): %s", first_source_key)
+    logging.debug("Source value: %s", first_source_value)
+    if not isinstance(first_source_value, dict):
+        return {"status": "failed", "message": "Source entry must be an object"}, 400
+
     code = first_source_value.get("content", "")
-    
+    if not isinstance(code, str):
+        return {"status": "failed", "message": "Source content must be a string"}, 400
+
     try:
-        out_dict = compile_code(
-            code,
-            first_source_key,
-            output_formats=['abi', 'bytecode', 'bytecode_runtime', 'source_map', 'method_identifiers']
-        )
-        # Create the artifact object with the expected structure
-        artifact = {
-            "manifest": "ethpm/3",
-            "name": None,
-            "version": None,
-            "meta": None,
-            "sources": {
-                first_source_key: {
-                    "content": code,
-                    "urls": [],
-                    "checksum": None,
-                    "type": None,
-                    "license": None,
-                    "references": None,
-                    "imports": None
-                }
-            },
-            "contractTypes": {
-                first_source_key.split('/')[-1].split('.')[0]: {  # Extract contract name from path
-                    "contractName": first_source_key.split('/')[-1].split('.')[0],
-                    "sourceId": first_source_key,
-                    "deploymentBytecode": {
-                        "bytecode": out_dict.get("bytecode", ""),
-                        "linkReferences": None,
-                        "linkDependencies": None
-                    },
-                    "runtimeBytecode": {
-                        "bytecode": out_dict.get("bytecode_runtime", ""),
-                        "linkReferences": None,
-                        "linkDependencies": None
-                    },
-                    "abi": out_dict.get("abi", []),
-                    "sourcemap": out_dict.get("source_map", ""),
-                    "methodIdentifiers": out_dict.get("method_identifiers", {})
-                }
-            },
-            "compilers": None,
-            "deployments": None,
-            "buildDependencies": None
-        }
-        
-        return artifact, 200
+        out_dict = _cached_compile(code, first_source_key, _OUTPUT_FORMATS)
+        return _build_artifact(code, first_source_key, out_dict), 200
         
     except VyperException as e:
-        error_msg = str(e)
-        return {"status": "failed", "message": error_msg}, 400
+        return {"status": "failed", "message": str(e)}, 400
     except Exception as e:
-        error_msg = str(e)
-        logging.error(f"Unexpected error during compilation: {error_msg}")
+        logging.error("Unexpected error during compilation: %s", e)
         return {"status": "failed", "message": "Internal compilation error"}, 500
 
-@routes.options('/compile')
-async def compile_it_options(request):
-    return web.json_response(status=200, headers=headers)
+def _compile_raw(raw):
+    # Decode the request body on the executor too, so large payloads don't
+    # block the event loop.
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError as e:
+        return {"status": "failed", "message": "Invalid JSON: {}".format(e)}, 400
+    if not isinstance(data, dict):
+        return {"status": "failed", "message": "Request body must be a JSON object"}, 400
+    return _compile(data)
+
+def _compile_encoded(raw):
+    # Pre-encode the result in both formats on the worker so GET /artifacts can
+    # send the bytes as-is instead of serializing the artifact on the event loop.
+    out, status = _compile_raw(raw)
+    try:
+        # _build_artifact already stringifies source_map keys; OPT_NON_STR_KEYS
+        # keeps any other int-keyed compiler output encodable, as stdlib json was.
+        return (orjson.dumps(out, option=orjson.OPT_NON_STR_KEYS),
+                msgpack.packb(out, use_bin_type=True), status)
+    except Exception as e:
+        logging.error("Failed to encode compilation result: %s", e)
+        out = {"status": "failed", "message": "Internal compilation error"}
+        return orjson.dumps(out), msgpack.packb(out, use_bin_type=True), 500
+
+def _open_results_db(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS results ("
+        "id TEXT PRIMARY KEY, status TEXT NOT NULL, data BLOB NOT NULL, packed BLOB NOT NULL, "
+        "ts INTEGER NOT NULL)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS results_ts ON results (ts)")
+    db.commit()
+    return db
+
+def _store_result(db, comp_id, status, data, packed):
+    db.execute(
+        "INSERT OR REPLACE INTO results (id, status, data, packed, ts) VALUES (?, ?, ?, ?, ?)",
+        (comp_id, status, data, packed, int(time.time()))
+    )
+    db.commit()
+
+def _load_status(db, comp_id):
+    row = db.execute(
+        "SELECT status FROM results WHERE id = ? AND ts >= ?",
+        (comp_id, int(time.time()) - RESULTS_TTL)
+    ).fetchone()
+    return row[0] if row is not None else None
+
+def _load_data(db, comp_id):
+    row = db.execute(
+        "SELECT data FROM results WHERE id = ? AND ts >= ?",
+        (comp_id, int(time.time()) - RESULTS_TTL)
+    ).fetchone()
+    return row[0] if row is not None else None
+
+def _load_packed(db, comp_id):
+    row = db.execute(
+        "SELECT packed FROM results WHERE id = ? AND ts >= ?",
+        (comp_id, int(time.time()) - RESULTS_TTL)
+    ).fetchone()
+    return row[0] if row is not None else None
+
+def _delete_expired(db):
+    db.execute(
+        "DELETE FROM results WHERE ts < ? OR id NOT IN "
+        "(SELECT id FROM results ORDER BY ts DESC LIMIT ?)",
+        (int(time.time()) - RESULTS_TTL, RESULTS_MAX)
+    )
+    db.commit()
+
+async def _run_db(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_pool, func, *args)
+
+async def _expire_results(db):
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await _run_db(_delete_expired, db)
+        except sqlite3.Error:
+            # Keep the janitor alive; the next pass retries.
+            logging.exception("Failed to delete expired results")
+
+async def _results_store(app):
+    db = await _run_db(_open_results_db, RESULTS_DB)
+    app[results_db] = db
+    janitor = asyncio.create_task(_expire_results(db))
+    yield
+    janitor.cancel()
+    await _run_db(db.close)
+
+def _store_unavailable():
+    return web.Response(text="RESULT STORE UNAVAILABLE", status=503)
+
+def _busy():
+    global _last_busy_log
+    # Log at most every 10 seconds so an overload doesn't also flood the logs.
+    now = time.monotonic()
+    if now - _last_busy_log >= 10:
+        _last_busy_log = now
+        logging.warning("Compile queue full (%d pending), responding 429", _compile_pending)
+    return web.Response(text="BUSY", status=429, headers={"Retry-After": "2"})
 
 @routes.post('/compile')
 async def compile_it(request):
-    data = await request.json()
-    loop = asyncio.get_event_loop()
-    out, status = await loop.run_in_executor(executor_pool, _compile, data)
+    global _compile_pending
+    if _compile_pending >= _compile_inflight + _compile_max_waiting:
+        return _busy()
+    _compile_pending += 1
+    try:
+        async with _compile_sem:
+            raw = await request.read()
+            key = hashlib.blake2b(raw, digest_size=16).digest()
+            try:
+                if key in _inflight:
+                    future, pool = _inflight[key]
+                else:
+                    pool = executor_pool
+                    loop = asyncio.get_event_loop()
+                    future = loop.run_in_executor(pool, _compile_encoded, raw)
+                    _inflight[key] = (future, pool)
+                    future.add_done_callback(lambda _: _inflight.pop(key, None))
+                # Shield so one client disconnecting doesn't cancel the others' compile.
+                encoded, packed, status = await asyncio.shield(future)
+            except BrokenProcessPool:
+                _replace_broken_pool(pool)
+                return web.Response(text="COMPILER RESTARTING", status=503,
+                                    headers={"Retry-After": "2"})
+    finally:
+        _compile_pending -= 1
     # Generate a unique id similar to a temporary hash (with a "tmp" prefix)
-    unique_id = "tmp" + str(uuid.uuid4())[:10]
+    unique_id = "tmp" + secrets.token_urlsafe(8)
     # Store the result with a status based on the compilation outcome.
-    compilation_results[unique_id] = {
-        'status': 'SUCCESS' if status == 200 else 'FAILURE',
-        'data': out
-    }
-    return web.json_response(unique_id, status=status, headers=headers)
+    try:
+        await _run_db(_store_result, request.app[results_db], unique_id,
+                      'SUCCESS' if status == 200 else 'FAILURE', encoded, packed)
+    except sqlite3.Error:
+        logging.exception("Failed to store compilation result %s", unique_id)
+        return _store_unavailable()
+    return _json(unique_id, status=status)
 
 @routes.get('/status/{id}')
 async def check_status(request):
     comp_id = request.match_info['id']
-    if comp_id in compilation_results:
-        return web.Response(text=compilation_results[comp_id]['status'], status=200, headers=headers)
+    try:
+        result = await _run_db(_load_status, request.app[results_db], comp_id)
+    except sqlite3.Error:
+        logging.exception("Failed to load status for %s", comp_id)
+        return _store_unavailable()
+    if result is not None:
+        return web.Response(text=result, status=200)
     else:
-        return web.Response(text="NOT FOUND", status=404, headers=headers)
+        return web.Response(text="NOT FOUND", status=404)
 
 @routes.get('/artifacts/{id}')
 async def get_artifacts(request):
     comp_id = request.match_info['id']
-    if comp_id in compilation_results:
-        return web.json_response(compilation_results[comp_id]['data'], status=200, headers=headers)
+    wants_msgpack = _wants_msgpack(request)
+    try:
+        result = await _run_db(_load_packed if wants_msgpack else _load_data,
+                               request.app[results_db], comp_id)
+    except sqlite3.Error:
+        logging.exception("Failed to load artifacts for %s", comp_id)
+        return _store_unavailable()
+    if result is not None:
+        # The body depends on Accept, so caches must not mix the two formats.
+        content_type = "application/msgpack" if wants_msgpack else "application/json"
+        return await _send_bytes(request, result, content_type, status=200,
+                                 headers={"Vary": "Accept"})
     else:
-        return web.Response(text="NOT FOUND", status=404, headers=headers)
+        return web.Response(text="NOT FOUND", status=404)
+
+def make_app():
+    app = web.Application(client_max_size=client_max_size)
+    app.cleanup_ctx.append(_results_store)
+
+    # aiohttp_cors answers preflight requests and adds CORS headers to responses
+    cors = cors_setup(app, defaults={
+        "*": ResourceOptions(
+            allow_methods=["GET", "POST"],
+            allow_headers=("Content-Type", "X-Requested-With"),
+            expose_headers=("Retry-After",),
+            max_age=86400
+        )
+    })
+    app.add_routes(routes)
+    for route in list(app.router.routes()):
+        cors.add(route)
+    return app
 
 def main():
+    # Use uvloop's faster event loop when it's available (not on Windows)
+    try:
+        import uvloop
+        loop = uvloop.new_event_loop()
+    except ImportError:
+        loop = None
     # Configure aiohttp to use charset-normalizer instead of cchardet
     ClientResponse._get_charset = lambda self: None
-    app = web.Application()
-    app.add_routes(routes)
+    app = make_app()
     logging.basicConfig(level=logging.DEBUG)
-    web.run_app(app)
+    web.run_app(app, loop=loop, backlog=128)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,64 @@
+import asyncio
+
+import msgpack
+import orjson
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import https_server
+import server
+
+CONTRACT = """
+@external
+def answer() -> uint256:
+    return 42
+"""
+
+
+@pytest.mark.parametrize("module", [server, https_server])
+def test_compile_status_artifacts_round_trip(module, tmp_path, monkeypatch):
+    monkeypatch.setattr(module, "RESULTS_DB", str(tmp_path / "artifacts.db"))
+
+    async def run():
+        async with TestClient(TestServer(module.make_app())) as client:
+            resp = await client.post("/compile", json={
+                "sources": {"contracts/Answer.vy": {"content": CONTRACT}}
+            })
+            assert resp.status == 200
+            comp_id = await resp.json()
+
+            resp = await client.get("/status/{}".format(comp_id))
+            assert resp.status == 200
+            assert await resp.text() == "SUCCESS"
+
+            resp = await client.get("/artifacts/{}".format(comp_id))
+            assert resp.status == 200
+            artifact = await resp.json()
+            contract = artifact["contractTypes"]["Answer"]
+            assert contract["sourceId"] == "contracts/Answer.vy"
+            assert contract["deploymentBytecode"]["bytecode"].startswith("0x")
+            assert contract["methodIdentifiers"]["answer()"] == "0x85bb7d69"
+            assert contract["sourcemap"]["pc_pos_map"]
+            assert artifact["sources"]["contracts/Answer.vy"]["content"] == CONTRACT
+
+            resp = await client.get("/artifacts/{}".format(comp_id),
+                                    headers={"Accept": "application/msgpack"})
+            assert resp.status == 200
+            assert resp.headers["Content-Type"] == "application/msgpack"
+            assert resp.headers["Vary"] == "Accept"
+            assert msgpack.unpackb(await resp.read()) == artifact
+
+            resp = await client.get("/artifacts/{}".format(comp_id), headers={
+                "Accept": "application/json, application/msgpack;q=0"
+            })
+            assert resp.headers["Content-Type"] == "application/json"
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("module", [server, https_server])
+def test_unencodable_result_becomes_failure(module, monkeypatch):
+    monkeypatch.setattr(module, "_compile_raw", lambda raw: ({"bad": object()}, 200))
+    encoded, packed, status = module._compile_encoded(b"{}")
+    assert status == 500
+    assert orjson.loads(encoded) == {"status": "failed", "message": "Internal compilation error"}